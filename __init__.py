@@ -1,10 +1,13 @@
 """Mode utility."""
+import copy
+import dataclasses
+
 import torch
 
 # mode metrics
-from . import math, meter, metrics, tracer, check
+from . import math, meter, metrics, tracer, check, search, graph
 # mode datafile
-from .datafile import resize_image
+from .datafile import letterbox, resize_image
 
 _COLORS = dict(
     Red='\033[91m',
@@ -64,10 +67,85 @@ def get_named_function(module):
 def one_hot(uidx, num):
     """Convert the index to one-hot encoding."""
     uidx = uidx.view(-1, 1)
-    one_hot = torch.zeros(uidx.numel(), num).to(uidx.device)
+    one_hot = torch.zeros(uidx.numel(), num, device=uidx.device)
     return one_hot.scatter_(1, uidx, 1.0)
 
 
+def _bag_rows(uidx, offsets):
+    """Return the row (bag) of each index and the row pointers."""
+    if offsets is None:
+        rows = torch.arange(uidx.numel(), device=uidx.device)
+        return rows, torch.arange(uidx.numel() + 1, device=uidx.device)
+    crow = torch.cat((offsets, offsets.new_tensor([uidx.numel()])))
+    rows = torch.repeat_interleave(
+        torch.arange(len(offsets), device=uidx.device), crow.diff())
+    return rows, crow
+
+
+def sparse_one_hot(uidx, num, offsets=None, per_sample_weights=None,
+                   layout=torch.sparse_coo):
+    """Convert the index to sparse one-hot (or multi-hot) encoding.
+
+    Parameters
+    ----------
+    uidx: indices, flattened like one_hot
+    num: number of classes
+    offsets: if given, uidx[offsets[i]:offsets[i+1]] is the i-th bag, same
+        as torch.nn.functional.embedding_bag, and each row is multi-hot
+    per_sample_weights: values for each index, ones if None
+    layout: torch.sparse_coo or torch.sparse_csr
+
+    Return
+    ------
+    one_hot: sparse matrix of (num_rows, num) on the device of uidx
+    """
+    uidx = uidx.view(-1)
+    rows, crow = _bag_rows(uidx, offsets)
+    if per_sample_weights is None:
+        values = torch.ones(uidx.numel(), device=uidx.device)
+    else:
+        values = per_sample_weights.view(-1)
+    size = (len(crow) - 1, num)
+    indices = torch.stack((rows, uidx))
+    # coalesce sorts the columns of each row and sums duplicated indices
+    one_hot = torch.sparse_coo_tensor(indices, values, size).coalesce()
+    if layout == torch.sparse_csr:
+        return one_hot.to_sparse_csr()
+    return one_hot
+
+
+def one_hot_mm(uidx, weight, offsets=None, per_sample_weights=None,
+               mode='sum'):
+    """Compute one_hot(uidx, num) @ weight without the one-hot matrix.
+
+    Rows of weight are gathered directly. With offsets, uidx are bags as
+    in torch.nn.functional.embedding_bag, i.e. a (weighted) multi-hot
+    matrix times weight for mode 'sum'.
+    """
+    import torch.nn.functional as F
+    uidx = uidx.view(-1)
+    if offsets is None:
+        output = F.embedding(uidx, weight)
+        if per_sample_weights is not None:
+            output = output * per_sample_weights.view(-1, 1)
+        return output
+    return F.embedding_bag(uidx, weight, offsets, mode=mode,
+                           per_sample_weights=per_sample_weights)
+
+
+def test_sparse_one_hot():
+    uidx = torch.tensor([3, 1, 1, 0, 2])
+    offsets = torch.tensor([0, 3])
+    weight = torch.randn(4, 5)
+    dense = torch.tensor([[0., 2., 0., 1.], [1., 0., 1., 0.]])
+    with torch.sparse.check_sparse_tensor_invariants():
+        for layout in [torch.sparse_coo, torch.sparse_csr]:
+            one_hot = sparse_one_hot(uidx, 4, offsets, layout=layout)
+            assert one_hot.layout == layout
+            assert torch.equal(one_hot.to_dense(), dense)
+    assert torch.allclose(one_hot_mm(uidx, weight, offsets), dense @ weight)
+
+
 def get_device(gpus=None):
     """Decide which device to use for data when given gpus.
 
@@ -94,7 +172,7 @@ def get_device(gpus=None):
 
 def to_device(data, device):
     """Move data to device."""
-    from collections import Sequence
+    from collections.abc import Sequence
     error_msg = "data must contain tensors or lists; found {}"
     if isinstance(data, Sequence):
         return tuple(to_device(v, device) for v in data)
@@ -103,6 +181,128 @@ def to_device(data, device):
     raise TypeError((error_msg.format(type(data))))
 
 
+def _collect_tensors(data, tensors):
+    """Collect tensors in nested containers in depth-first order."""
+    if isinstance(data, torch.Tensor):
+        tensors.append(data)
+    elif isinstance(data, dict):
+        for v in data.values():
+            _collect_tensors(v, tensors)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            _collect_tensors(v, tensors)
+    elif dataclasses.is_dataclass(data) and not isinstance(data, type):
+        for f in dataclasses.fields(data):
+            _collect_tensors(getattr(data, f.name), tensors)
+
+
+def _replace_tensors(data, tensors):
+    """Rebuild data with tensors from the iterator in collected order."""
+    if isinstance(data, torch.Tensor):
+        return next(tensors)
+    if isinstance(data, dict):
+        items = [(k, _replace_tensors(v, tensors)) for k, v in data.items()]
+        try:
+            return type(data)(items)
+        except TypeError:
+            return dict(items)
+    if isinstance(data, tuple) and hasattr(data, '_fields'):
+        return type(data)(*[_replace_tensors(v, tensors) for v in data])
+    if isinstance(data, (list, tuple)):
+        return type(data)(_replace_tensors(v, tensors) for v in data)
+    if dataclasses.is_dataclass(data) and not isinstance(data, type):
+        values = {f.name: _replace_tensors(getattr(data, f.name), tensors)
+                  for f in dataclasses.fields(data)}
+        result = copy.copy(data)
+        for k, v in values.items():
+            object.__setattr__(result, k, v)
+        return result
+    return data
+
+
+def coalesced_to_device(data, device, dtype=None, non_blocking=False):
+    """Move nested data to device with one transfer for each dtype.
+
+    Tensors of the same dtype and device are packed into one flat buffer,
+    which is moved (and cast) once, and the returned tensors are views of
+    it. Tensors that require grad are moved one by one with Tensor.to to
+    keep autograd.
+
+    The packing only pays off for many small host-to-GPU copies, where each
+    copy has a fixed latency. On CPU it is an extra copy and is usually
+    slower than per-tensor calls, run :func:`benchmark_to_device` to
+    compare on the target machine.
+
+    Parameters
+    ----------
+    data: tensors in nested dicts, (named)tuples, lists and dataclasses,
+        other objects are kept as they are
+    device: target device
+    dtype: None to keep dtypes, a dtype to cast all floating tensors, or a
+        dict that maps source dtypes to target dtypes
+    non_blocking: use pinned memory and asynchronous copy for CUDA
+    """
+    tensors = []
+    _collect_tensors(data, tensors)
+    if not tensors:
+        return data
+    if dtype is None:
+        dtype = {}
+    elif isinstance(dtype, torch.dtype):
+        dtype = {t.dtype: dtype for t in tensors if t.is_floating_point()}
+    device = torch.device(device)
+    groups = {}
+    results = [None] * len(tensors)
+    for n, t in enumerate(tensors):
+        if t.requires_grad:
+            results[n] = t.to(device, dtype=dtype.get(t.dtype, t.dtype),
+                              non_blocking=non_blocking)
+        else:
+            groups.setdefault((t.dtype, t.device), []).append(n)
+    for (src_dtype, src_device), index in groups.items():
+        dst_dtype = dtype.get(src_dtype, src_dtype)
+        if dst_dtype == src_dtype and src_device == device:
+            # nothing to move, same as Tensor.to
+            for n in index:
+                results[n] = tensors[n]
+            continue
+        # cast while packing if it makes the buffer smaller
+        pack_dtype = src_dtype
+        if dst_dtype.itemsize <= src_dtype.itemsize:
+            pack_dtype = dst_dtype
+        sizes = [tensors[n].numel() for n in index]
+        pin = (non_blocking and device.type == 'cuda'
+               and src_device.type == 'cpu')
+        buffer = torch.empty(sum(sizes), dtype=pack_dtype, device=src_device,
+                             pin_memory=pin)
+        torch.cat([tensors[n].reshape(-1) if tensors[n].dim() != 1
+                   else tensors[n] for n in index], out=buffer)
+        buffer = buffer.to(device, dtype=dst_dtype, non_blocking=non_blocking)
+        for n, flat in zip(index, buffer.split(sizes)):
+            results[n] = flat if tensors[n].dim() == 1 else flat.view(
+                tensors[n].shape)
+    return _replace_tensors(data, iter(results))
+
+
+def benchmark_to_device(num_tensors=1000, size=16, steps=20,
+                        device='cpu', dtype=torch.float16):
+    """Compare to_device and coalesced_to_device on nested batches."""
+    import time
+    batch = [dict(x=torch.randn(size), y=torch.randint(0, 10, (size, )))
+             for _ in range(num_tensors // 2)]
+    start = time.time()
+    for _ in range(steps):
+        [{k: v.to(device, dtype=dtype if v.is_floating_point() else v.dtype)
+          for k, v in b.items()} for b in batch]
+    per_tensor = (time.time() - start) / steps
+    start = time.time()
+    for _ in range(steps):
+        coalesced_to_device(batch, device, dtype)
+    coalesced = (time.time() - start) / steps
+    return dict(num_tensors=num_tensors, size=size, per_tensor=per_tensor,
+                coalesced=coalesced)
+
+
 def config_log(stream_level='DEBUG', file_level='INFO', log_file=None):
     """Config logging with dictConfig.
     Parameters
@@ -159,4 +359,6 @@ __all__ = [
     'tracer',
     'meter',
     'metrics',
+    'search',
+    'graph',
 ]
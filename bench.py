@@ -0,0 +1,276 @@
+"""Benchmarks for hot paths of utils with regression tracking.
+
+Usage:
+------
+    $ python -m utils.bench --output results.json
+    $ python -m utils.bench --baseline results.json --threshold 1.2
+
+Each case is registered by :func:`case` with a list of input sizes. The
+decorated function prepares the inputs of one size and returns a callable
+to be timed. Results are saved as json and compared with a baseline, and
+a case is a regression if it is slower than threshold times the baseline.
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import torch
+
+LOGGER = logging.getLogger(__name__)
+
+CASES = dict()
+
+
+def case(sizes):
+    """Register a benchmark case with input sizes."""
+    def wrapper(func):
+        CASES[func.__name__] = (func, list(sizes))
+        return func
+    return wrapper
+
+
+def _scores(num_users, num_items=100):
+    posi = [np.random.rand(num_items // 10) for _ in range(num_users)]
+    nega = [np.random.rand(num_items) for _ in range(num_users)]
+    return posi, nega
+
+
+@case(sizes=[100, 1000])
+def metrics_ndcg(size):
+    from utils import metrics
+    posi, nega = _scores(size)
+    return lambda: metrics.NDCG(posi, nega)
+
+
+@case(sizes=[10, 100])
+def metrics_roc(size):
+    from utils import metrics
+    posi, nega = _scores(size)
+    return lambda: metrics.ROC(posi, nega)
+
+
+@case(sizes=[100, 1000])
+def metrics_precision(size):
+    from utils import metrics
+    posi, nega = _scores(size)
+    return lambda: metrics.Precision(posi, nega)
+
+
+@case(sizes=[200, 1000])
+def metrics_aa(size):
+    from utils import metrics
+    A = (np.random.rand(size, size) < 0.05).astype(np.float64)
+    A = np.maximum(A, A.T)
+    pos = np.random.randint(0, size, (2, size))
+    neg = np.random.randint(0, size, (2, size))
+    return lambda: metrics.AA(A, pos, neg)
+
+
+@case(sizes=[1000, 100000])
+def math_smooth(size):
+    from utils import math
+    xs = np.random.rand(size)
+    return lambda: math.smooth(xs, 10)
+
+
+@case(sizes=[8, 64])
+def math_hamming_sim(size):
+    from utils import math
+    bits = 8
+    a = np.random.choice([-1, 1], size * bits)
+    b = np.random.choice([-1, 1], size * bits)
+    x, y = math.convert_to_int(a, bits), math.convert_to_int(b, bits)
+    tables = math.build_look_table(np.random.randn(size * bits), bits)
+    tables = tables.reshape(-1)
+    offset = np.arange(size) * (2 ** bits)
+    return lambda: math.hamming_sim(x, y, tables, offset)
+
+
+@case(sizes=[1000, 10000])
+def math_gnn_spmm(size):
+    from utils import math
+    index = torch.randint(0, size, (2, size * 10))
+    sp_mat = torch.sparse_coo_tensor(
+        index, torch.rand(index.shape[1]), (size, size)).coalesce()
+    x = torch.randn(size, 64, requires_grad=True)
+
+    def run():
+        math.gnn_spmm(sp_mat, x).sum().backward()
+    return run
+
+
+@case(sizes=[1000, 10000])
+def meter_avg_meter(size):
+    from utils import meter
+
+    def run():
+        m = meter.AvgMeter(win_size=50)
+        for i in range(size):
+            m.update(i, 1.0)
+            m.avg
+    return run
+
+
+@case(sizes=[1000, 10000])
+def meter_global_meter(size):
+    from utils import meter
+
+    def run():
+        m = meter.GlobalMeter()
+        for i in range(size):
+            m.update(i, 1.0)
+            m.avg
+    return run
+
+
+@case(sizes=[1000, 10000])
+def tracer_update_history(size):
+    from utils.tracer import Tracer
+    data = dict(loss=1.0, accuracy=0.5, auc=0.5)
+
+    def run():
+        tracer = Tracer(win_size=50)
+        for i in range(size):
+            tracer.update_history(i, data)
+    return run
+
+
+@case(sizes=[1000, 10000])
+def check_list_files(size):
+    from utils import check
+    folder = tempfile.mkdtemp(dir=_tmp_dir())
+    for n in range(size):
+        sub = os.path.join(folder, str(n % 10))
+        os.makedirs(sub, exist_ok=True)
+        open(os.path.join(sub, '{}.jpg'.format(n)), 'w').close()
+    return lambda: check.list_files(folder, '.jpg', recursive=True)
+
+
+@case(sizes=[256, 1024])
+def datafile_resize_image(size):
+    import cv2
+    from utils import datafile
+    folder = tempfile.mkdtemp(dir=_tmp_dir())
+    src = os.path.join(folder, 'src.png')
+    dest = os.path.join(folder, 'dest.png')
+    img = np.random.randint(0, 256, (size, size * 3 // 4, 3), np.uint8)
+    cv2.imwrite(src, img)
+    return lambda: datafile.resize_image(src, dest, [224, 224])
+
+
+_TMP = []
+
+
+def _tmp_dir():
+    """Return a temporary folder removed after all cases run."""
+    if not _TMP:
+        _TMP.append(tempfile.mkdtemp())
+    return _TMP[0]
+
+
+def _environment():
+    return dict(python=platform.python_version(), numpy=np.__version__,
+                torch=torch.__version__, machine=platform.machine())
+
+
+def run(names=None, repeat=5):
+    """Run benchmark cases.
+
+    Parameters
+    ----------
+    names: names of cases to run, all cases if None
+    repeat: number of repeats, the min time is reported
+
+    Return
+    ------
+    results: dict of 'case[size]' and seconds per call
+    """
+    results = dict()
+    try:
+        for name in names or sorted(CASES):
+            func, sizes = CASES[name]
+            for size in sizes:
+                timer = timeit.Timer(func(size))
+                # each repeat takes at least 0.2 seconds
+                number, _ = timer.autorange()
+                best = min(timer.repeat(repeat, number)) / number
+                key = '{}[{}]'.format(name, size)
+                results[key] = best
+                LOGGER.info('%-40s %.3e s', key, best)
+    finally:
+        while _TMP:
+            shutil.rmtree(_TMP.pop(), ignore_errors=True)
+    return results
+
+
+def save(results, fn):
+    """Save results to json with the environment."""
+    with open(fn, 'w') as f:
+        json.dump(dict(environment=_environment(), results=results), f,
+                  indent=2, sort_keys=True)
+
+
+def load(fn):
+    """Load results saved by :func:`save`."""
+    with open(fn) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold=1.2):
+    """Compare results with baseline.
+
+    Return
+    ------
+    regressions: list of (case, baseline, result, ratio) where the ratio
+        result / baseline is larger than threshold
+    """
+    regressions = []
+    for key, value in sorted(results.items()):
+        if key not in baseline:
+            continue
+        ratio = value / baseline[key]
+        if ratio > threshold:
+            regressions.append((key, baseline[key], value, ratio))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark utils.')
+    parser.add_argument('cases', nargs='*', help='cases to run, all if empty')
+    parser.add_argument('--output', help='json file to save results')
+    parser.add_argument('--baseline', help='json file of baseline results')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='max allowed ratio of time to the baseline')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--list', action='store_true', help='list cases')
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, (_, sizes) in sorted(CASES.items()):
+            print(name, sizes)
+        return 0
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error('unknown cases: {}'.format(', '.join(sorted(unknown))))
+    results = run(args.cases, args.repeat)
+    if args.output:
+        save(results, args.output)
+    if args.baseline:
+        regressions = compare(results, load(args.baseline), args.threshold)
+        for key, base, value, ratio in regressions:
+            LOGGER.error('%s: %.3e s -> %.3e s (x%.2f)',
+                         key, base, value, ratio)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sys.exit(main())
@@ -1,9 +1,19 @@
 """Check utils mod."""
 import os
 import collections
+import json
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
 LOGGER = logging.getLogger(__name__)
 
+_PATH_CHECKS = {
+    'file': os.path.isfile,
+    'dir': os.path.isdir,
+    'exists': os.path.exists,
+}
+
 
 def check_dirs(folders, action='check', mode='all', verbose=False):
     """Check whether all folders exist."""
@@ -84,6 +94,86 @@ def check_exists(lists, mode='any', verbose=False):
     return ops[mode](exists)
 
 
+def _check_group(folder, names, kind):
+    """Check names in one folder by listing the folder once."""
+    check = _PATH_CHECKS[kind]
+    try:
+        with os.scandir(folder or '.') as entries:
+            listed = {e.name: e for e in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return [False] * len(names)
+    except OSError:
+        return [check(os.path.join(folder, n)) for n in names]
+    flags = []
+    for name in names:
+        entry = listed.get(name)
+        if entry is None:
+            flags.append(False)
+        elif kind == 'file':
+            flags.append(entry.is_file())
+        elif kind == 'dir':
+            flags.append(entry.is_dir())
+        else:
+            # special files are neither files nor folders
+            flags.append(entry.is_file() or entry.is_dir()
+                         or os.path.exists(entry.path))
+    return flags
+
+
+def check_paths(paths, kind='file', mode='any', num_workers=16,
+                verbose=False):
+    """Check whether many paths exist.
+
+    Paths are grouped by parent folder so that each folder is listed only
+    once, single paths in a folder are checked with stat. All checks run
+    in a thread pool.
+
+    Parameters
+    ----------
+    paths: list of paths to check
+    kind: 'file', 'dir' or 'exists', same as os.path.isfile/isdir/exists
+    mode: whether it requires all paths exist or any one exists
+    num_workers: number of threads
+    Return
+    ------
+    result: the final decision according to mode
+    flags: boolean array of each path
+    """
+    if kind not in _PATH_CHECKS:
+        raise ValueError("{} not in {}".format(kind, list(_PATH_CHECKS)))
+    if mode.lower() not in ['all', 'any']:
+        raise ValueError("{} not in ['all', 'any']".format(mode.lower()))
+    ops = {'any': any, 'all': all}
+    groups = collections.defaultdict(list)
+    singles = []
+    for i, path in enumerate(paths):
+        folder, name = os.path.split(path)
+        if name in ['', '.', '..']:
+            singles.append(i)
+        else:
+            groups[folder].append(i)
+    for folder in [f for f, idx in groups.items() if len(idx) == 1]:
+        singles += groups.pop(folder)
+    flags = np.zeros(len(paths), dtype=bool)
+    with ThreadPoolExecutor(num_workers) as pool:
+        futures = {
+            pool.submit(_check_group, folder,
+                        [os.path.basename(paths[i]) for i in idx], kind): idx
+            for folder, idx in groups.items()
+        }
+        check = _PATH_CHECKS[kind]
+        for i, flag in zip(singles, pool.map(check,
+                                             [paths[i] for i in singles])):
+            flags[i] = flag
+        for future, idx in futures.items():
+            flags[idx] = future.result()
+    if verbose:
+        LOGGER.info('names\t status')
+        info = [str(p) + '\t' + str(f) for p, f in zip(paths, flags)]
+        LOGGER.info('\n'.join(info))
+    return ops[mode.lower()](flags.tolist()), flags
+
+
 def list_files(folder='./', suffix='', recursive=False):
     """List all files.
 
@@ -99,3 +189,244 @@ def list_files(folder='./', suffix='', recursive=False):
     else:
         files = [f for f in os.listdir(folder) if f.endswith(suffix)]
     return files
+
+
+def _suffix_matcher(suffix):
+    """Return a function to check whether a filename matches suffix.
+
+    Plain extensions (e.g. '.jpg') are matched with a set lookup, other
+    suffixes fall back to str.endswith.
+    """
+    if isinstance(suffix, str):
+        suffix = (suffix, )
+    suffix = tuple(suffix)
+    if '' in suffix:
+        return lambda name: True
+    if all(s.startswith('.') and s.count('.') == 1 for s in suffix):
+        exts = frozenset(suffix)
+        return lambda name: name[name.rfind('.'):] in exts
+    return lambda name: name.endswith(suffix)
+
+
+def _scan_dir(path, match, key='path'):
+    """Scan one directory, return matched files and sub-directories.
+
+    key: 'path' to return joined paths and 'name' to return names only
+    """
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # DirEntry caches the type, so no extra stat is needed
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(getattr(entry, key))
+                elif match(entry.name):
+                    files.append(getattr(entry, key))
+    except OSError as err:
+        LOGGER.debug("Failed to scan '%s': %s", path, err)
+    return files, dirs
+
+
+def iter_files(folder='./', suffix='', recursive=False, max_depth=None,
+               num_workers=8):
+    """Iterate over files, sub-folders are scanned concurrently.
+
+    Parameters
+    ----------
+    suffix: filename must end with suffix if given, it can also be a list
+    recursive: if recursive, also scan sub-folders
+    max_depth: max depth of sub-folders to scan, unlimited if None
+    num_workers: number of threads for scanning
+    Yield
+    -----
+    path: path of file joined with folder, in no particular order
+    """
+    match = _suffix_matcher(suffix)
+    if not recursive:
+        max_depth = 0
+    pool = ThreadPoolExecutor(num_workers)
+    try:
+        pending = {pool.submit(_scan_dir, folder, match): 0}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                files, dirs = future.result()
+                if max_depth is None or depth < max_depth:
+                    for path in dirs:
+                        future = pool.submit(_scan_dir, path, match)
+                        pending[future] = depth + 1
+                yield from files
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class PathArray(object):
+    """Read-only list of paths stored as a string blob plus offsets.
+
+    Parameters
+    ----------
+    root: folder that paths are relative to
+    blob: uint8 array of concatenated relative paths
+    offsets: int64 array, the i-th path is blob[offsets[i]:offsets[i+1]]
+    """
+
+    def __init__(self, root, blob, offsets):
+        self.root = root
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index out of range')
+        name = self.blob[self.offsets[index]:self.offsets[index + 1]]
+        return os.path.join(self.root, os.fsdecode(name.tobytes()))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        """Return paths as a list."""
+        return list(self)
+
+
+def _refresh_dir(folder, rel, match, mtime):
+    """Return (mtime, files, dirs) of folder/rel, files and dirs are None
+    if mtime is unchanged."""
+    path = os.path.join(folder, rel)
+    try:
+        new_mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None, None, None
+    if new_mtime == mtime:
+        return mtime, None, None
+    files, dirs = _scan_dir(path, match, key='name')
+    return new_mtime, files, dirs
+
+
+def _load_manifest(manifest):
+    """Load the manifest, return (meta, blob, offsets) or None."""
+    try:
+        with open(os.path.join(manifest, 'meta.json')) as f:
+            meta = json.load(f)
+        blob = np.load(os.path.join(manifest, 'blob.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(manifest, 'offsets.npy'),
+                          mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return meta, blob, offsets
+
+
+def _save_manifest(manifest, meta, blob, offsets):
+    """Save the manifest, each file is replaced atomically."""
+    os.makedirs(manifest, exist_ok=True)
+    for name, array in [('blob.npy', blob), ('offsets.npy', offsets)]:
+        fn = os.path.join(manifest, name)
+        with open(fn + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(fn + '.tmp', fn)
+    fn = os.path.join(manifest, 'meta.json')
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(fn + '.tmp', fn)
+
+
+def list_files_cached(folder, manifest, suffix='', mmap=False,
+                      num_workers=8):
+    """List all files recursively with a manifest on disk.
+
+    The manifest saves the listing and the mtime of each folder. Later
+    calls only re-scan folders whose mtime has changed. A manifest saved
+    for another folder or suffix is rebuilt from scratch.
+
+    Parameters
+    ----------
+    folder: the folder to process
+    manifest: folder to save the manifest
+    suffix: filename must end with suffix if given, it can also be a list
+    mmap: if True, return a memory-mapped :class:`PathArray`
+    num_workers: number of threads for checking folders
+    Return
+    ------
+    files: paths of files joined with folder, same as
+        list_files(folder, suffix, recursive=True) but sorted by folder
+    """
+    match = _suffix_matcher(suffix)
+    key = suffix if isinstance(suffix, str) else sorted(suffix)
+    root = os.path.abspath(folder)
+    cached = _load_manifest(manifest)
+    old_dirs = {}
+    if (cached is not None and cached[0]['suffix'] == key
+            and cached[0].get('folder') == root):
+        meta, old_blob, old_offsets = cached
+        old_dirs = {d[0]: d[1:] for d in meta['dirs']}
+    else:
+        old_blob, old_offsets = np.empty(0, np.uint8), np.zeros(1, np.int64)
+    changed = len(old_dirs) == 0
+    dirs = {}
+    pool = ThreadPoolExecutor(num_workers)
+    try:
+        rel = ''
+        mtime = old_dirs.get(rel, [None])[0]
+        pending = {pool.submit(_refresh_dir, folder, rel, match, mtime): rel}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel = pending.pop(future)
+                mtime, files, subdirs = future.result()
+                if mtime is None:
+                    changed = True
+                    continue
+                if files is None:
+                    # unchanged folder, reuse the cached listing
+                    _, start, stop, subdirs = old_dirs[rel]
+                    dirs[rel] = (mtime, (start, stop), subdirs)
+                else:
+                    changed = True
+                    subdirs = [os.path.join(rel, d) for d in subdirs]
+                    files = [os.fsencode(os.path.join(rel, f))
+                             for f in sorted(files)]
+                    dirs[rel] = (mtime, files, subdirs)
+                for sub in subdirs:
+                    mtime = old_dirs.get(sub, [None])[0]
+                    future = pool.submit(_refresh_dir, folder, sub, match,
+                                         mtime)
+                    pending[future] = sub
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    if changed or len(dirs) != len(old_dirs):
+        chunks, lengths, records = [], [], []
+        num = 0
+        for rel in sorted(dirs):
+            mtime, files, subdirs = dirs[rel]
+            if isinstance(files, tuple):
+                start, stop = files
+                begin, end = old_offsets[start], old_offsets[stop]
+                chunks.append(np.asarray(old_blob[begin:end]))
+                lengths.append(np.diff(old_offsets[start:stop + 1]))
+                size = stop - start
+            else:
+                chunks.append(np.frombuffer(b''.join(files), np.uint8))
+                lengths.append(np.array([len(f) for f in files], np.int64))
+                size = len(files)
+            records.append([rel, mtime, num, num + size, subdirs])
+            num += size
+        blob = np.concatenate(chunks) if chunks else np.empty(0, np.uint8)
+        offsets = np.zeros(num + 1, dtype=np.int64)
+        if num:
+            np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        _save_manifest(manifest, dict(folder=root, suffix=key, dirs=records),
+                       blob, offsets)
+        LOGGER.info("Manifest '%s' has been updated.", manifest)
+        _, old_blob, old_offsets = _load_manifest(manifest)
+    files = PathArray(folder, old_blob, old_offsets)
+    return files if mmap else files.tolist()
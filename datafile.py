@@ -1,14 +1,111 @@
 """Utils to handle data files."""
+import json
+import logging
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 import cv2
 
+from utils.check import iter_files
+
+LOGGER = logging.getLogger(__name__)
+
 
 def read_csv(fn)->np.array:
-    return np.array(pd.read_csv(fn, dtype=np.int))
+    return np.array(pd.read_csv(fn, dtype=np.int64))
+
+
+def _min_int_dtype(low, high):
+    """Return the smallest integer dtype that holds values in [low, high]."""
+    if low >= 0:
+        dtypes = [np.uint8, np.uint16, np.uint32, np.uint64]
+    else:
+        dtypes = [np.int8, np.int16, np.int32, np.int64]
+    for dtype in dtypes:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def iter_csv(fn, chunksize=1 << 20, dtype=None):
+    """Iterate over an integer csv file in chunks.
+
+    Parameters
+    ----------
+    fn: csv file
+    chunksize: number of rows in each chunk
+    dtype: dtype of all chunks, if None each chunk is cast to its own
+        smallest integer dtype, so the dtype may vary between chunks
+
+    Yield
+    -----
+    data: array of (chunksize, n_cols)
+    """
+    for chunk in pd.read_csv(fn, dtype=np.int64, chunksize=chunksize):
+        data = chunk.to_numpy()
+        if dtype is not None:
+            data = data.astype(dtype)
+        elif data.size:
+            data = data.astype(_min_int_dtype(data.min(), data.max()))
+        yield data
+
+
+def load_csv(fn, chunksize=1 << 20, mmap=True):
+    """Read an integer csv file with a binary cache.
+
+    The csv is parsed in chunks and saved as fn + '.npy' with the smallest
+    integer dtype. Later calls load (memory-map) the cache instead, until
+    the size or mtime of the csv changes. Building the cache takes two
+    passes over the csv, one for the shape and range of values and one to
+    write chunks into the memory-mapped cache, so the data is never held
+    in memory.
+
+    Parameters
+    ----------
+    fn: csv file, same as :func:`read_csv`
+    chunksize: number of rows parsed at once
+    mmap: whether to memory-map the cache
+
+    Return
+    ------
+    data: array of (n_rows, n_cols)
+    """
+    cache, meta_file = fn + '.npy', fn + '.npy.json'
+    stat = os.stat(fn)
+    meta = dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+    try:
+        with open(meta_file) as f:
+            valid = json.load(f) == meta and os.path.isfile(cache)
+    except (OSError, ValueError):
+        valid = False
+    if not valid:
+        n_rows, low, high = 0, 0, 0
+        n_cols = len(pd.read_csv(fn, nrows=0).columns)
+        for chunk in pd.read_csv(fn, dtype=np.int64, chunksize=chunksize):
+            if len(chunk):
+                data = chunk.to_numpy()
+                low = min(low, data.min()) if n_rows else data.min()
+                high = max(high, data.max()) if n_rows else data.max()
+                n_rows += len(data)
+        dtype = _min_int_dtype(low, high)
+        data = np.lib.format.open_memmap(
+            cache + '.tmp', mode='w+', dtype=dtype, shape=(n_rows, n_cols))
+        start = 0
+        for chunk in iter_csv(fn, chunksize, dtype):
+            data[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        data.flush()
+        del data
+        os.replace(cache + '.tmp', cache)
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f)
+        LOGGER.info("Cache of '%s' has been saved to '%s'.", fn, cache)
+    return np.load(cache, mmap_mode='r' if mmap else None)
 
 
 def save_csv(data, fn, cols):
@@ -16,6 +113,113 @@ def save_csv(data, fn, cols):
     df.to_csv(fn, index=False)
 
 
+class DataWriter(object):
+    """Write rows incrementally with constant memory, see :func:`save_csv`.
+
+    Rows are buffered into a block of block_size rows, and each full block
+    is formatted and written at once.
+
+    Parameters
+    ----------
+    fn: csv file, or folder for binary format
+    cols: column names
+    dtype: dtype of values
+    block_size: number of rows in each block
+    fmt: format of values in csv, e.g. '%.4f', it can be a list for each
+        column. '%d' for integer dtype and '%r' otherwise if None
+    binary: if True, each column is saved to a raw file col.bin in the
+        folder fn, see :func:`load_columns`
+    """
+
+    def __init__(self, fn, cols, dtype=np.float64, block_size=65536,
+                 fmt=None, binary=False):
+        self.fn = fn
+        self.cols = list(cols)
+        self.binary = binary
+        self.num_rows = 0
+        self._block = np.empty((block_size, len(self.cols)), dtype=dtype)
+        self._size = 0
+        if binary:
+            os.makedirs(fn, exist_ok=True)
+            self._files = [open(os.path.join(fn, c + '.bin'), 'wb')
+                           for c in self.cols]
+        else:
+            if fmt is None:
+                integer = np.issubdtype(self._block.dtype, np.integer)
+                fmt = '%d' if integer else '%r'
+            if isinstance(fmt, str):
+                fmt = [fmt] * len(self.cols)
+            self._row_fmt = ','.join(fmt) + '\n'
+            self._file = open(fn, 'w')
+            self._file.write(','.join(self.cols) + '\n')
+
+    def write(self, rows):
+        """Append a row of (n_cols, ) or rows of (n, n_cols)."""
+        rows = np.asarray(rows)
+        if rows.ndim not in [1, 2] or rows.shape[-1] != len(self.cols):
+            raise ValueError("rows of shape {} do not match {} columns."
+                             .format(rows.shape, len(self.cols)))
+        rows = rows.reshape(-1, len(self.cols))
+        block_size = len(self._block)
+        while len(rows):
+            n = min(block_size - self._size, len(rows))
+            self._block[self._size:self._size + n] = rows[:n]
+            self._size += n
+            rows = rows[n:]
+            if self._size == block_size:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered rows."""
+        block = self._block[:self._size]
+        if self.binary:
+            for f, column in zip(self._files, block.T):
+                f.write(np.ascontiguousarray(column).tobytes())
+        elif len(block):
+            text = (self._row_fmt * len(block)) % tuple(block.ravel().tolist())
+            self._file.write(text)
+        self.num_rows += self._size
+        self._size = 0
+
+    def close(self):
+        """Flush and close the file(s)."""
+        self.flush()
+        if self.binary:
+            for f in self._files:
+                f.close()
+            meta = dict(cols=self.cols, dtype=self._block.dtype.str,
+                        num_rows=self.num_rows)
+            with open(os.path.join(self.fn, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_columns(folder, mmap=True):
+    """Load columns written by :class:`DataWriter` in binary format.
+
+    Return
+    ------
+    columns: dict of column name and array
+    """
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = {}
+    for col in meta['cols']:
+        fn = os.path.join(folder, col + '.bin')
+        if mmap and meta['num_rows']:
+            columns[col] = np.memmap(fn, dtype=meta['dtype'], mode='r')
+        else:
+            columns[col] = np.fromfile(fn, dtype=meta['dtype'])
+    return columns
+
+
 def resize_image(src, dest, sizes=[224, 224]):
     """Resize fashion image.
 
@@ -24,6 +228,12 @@ def resize_image(src, dest, sizes=[224, 224]):
     Then resize the image to given sizes [new_height, new_width]
     """
     img = cv2.imread(src)
+    resized_img = _pad_resize(img, sizes)
+    cv2.imwrite(dest, resized_img)
+
+
+def _pad_resize(img, sizes):
+    """Pad the image to the ratio of sizes and resize it."""
     height, width, depth = img.shape
     ratio = 1.0 * height / width
     new_height = sizes[0]
@@ -32,16 +242,294 @@ def resize_image(src, dest, sizes=[224, 224]):
     if ratio > new_ratio:
         h = height
         w = int(height / new_ratio)
-        new_image = np.zeros((h, w, depth)).astype(np.uint8)
-        new_image[:] = 255
+        new_image = np.full((h, w, depth), 255, dtype=np.uint8)
         new_p = int((w - width) / 2)
         new_image[:, new_p:new_p + width, :] = img
     else:
-        h = int(new_ratio * height)
+        h = int(new_ratio * width)
         w = width
-        new_image = np.zeros((h, w, depth)).astype(np.uint8)
-        new_image[:] = 255
+        new_image = np.full((h, w, depth), 255, dtype=np.uint8)
         new_p = int((h - height) / 2)
         new_image[new_p:new_p + height, :, :] = img
-    resized_img = cv2.resize(new_image, (new_width, new_height))
-    cv2.imwrite(dest, resized_img)
+    return cv2.resize(new_image, (new_width, new_height))
+
+
+def letterbox(img, sizes=[224, 224], out=None, fill=255):
+    """Resize fashion image in memory, same rule as :func:`resize_image`.
+
+    The image is resized first and padded afterwards, so the padded canvas
+    of the original resolution is never allocated.
+
+    Parameters
+    ----------
+    img: uint8 array of (height, width, depth) or (height, width)
+    sizes: [new_height, new_width]
+    out: uint8 array of (new_height, new_width, ...) to write into,
+        allocated if None, so that buffers can be reused across calls
+    fill: value of padded pixels
+
+    Return
+    ------
+    out: the resized image
+    """
+    height, width = img.shape[:2]
+    new_height, new_width = sizes
+    if out is None:
+        out = np.empty((new_height, new_width) + img.shape[2:], np.uint8)
+    ratio = 1.0 * height / width
+    new_ratio = 1.0 * new_height / new_width
+    # the scale of the padded canvas in resize_image
+    if ratio > new_ratio:
+        scale = new_width / int(height / new_ratio)
+        new_p = int((int(height / new_ratio) - width) / 2)
+        h, w = new_height, max(1, int(round(width * scale)))
+        top, left = 0, min(int(round(new_p * scale)), new_width - w)
+    else:
+        scale = new_height / int(new_ratio * width)
+        new_p = int((int(new_ratio * width) - height) / 2)
+        h, w = max(1, int(round(height * scale))), new_width
+        top, left = min(int(round(new_p * scale)), new_height - h), 0
+    out[:top] = fill
+    out[top + h:] = fill
+    out[top:top + h, :left] = fill
+    out[top:top + h, left + w:] = fill
+    out[top:top + h, left:left + w] = cv2.resize(img, (w, h)).reshape(
+        (h, w) + img.shape[2:])
+    return out
+
+
+def _is_up_to_date(src, dest, check='mtime'):
+    """Whether dest is newer than src ('mtime') or non-empty ('size')."""
+    try:
+        stat = os.stat(dest)
+    except OSError:
+        return False
+    if check == 'mtime':
+        return stat.st_mtime >= os.stat(src).st_mtime
+    return stat.st_size > 0
+
+
+def _resize_one(args):
+    """Resize one image, return (src, status, error)."""
+    src, dest, sizes, check = args
+    try:
+        if check and _is_up_to_date(src, dest, check):
+            return src, 'skipped', None
+        img = cv2.imread(src)
+        if img is None:
+            raise IOError("failed to read '{}'".format(src))
+        folder, name = os.path.split(dest)
+        os.makedirs(folder or '.', exist_ok=True)
+        # keep the extension so that cv2 chooses the same encoder
+        tmp = os.path.join(folder, '.{}.{}.tmp{}'.format(
+            name, os.getpid(), os.path.splitext(name)[1]))
+        if not cv2.imwrite(tmp, _pad_resize(img, sizes)):
+            raise IOError("failed to write '{}'".format(dest))
+        os.replace(tmp, dest)
+    except Exception as err:
+        return src, 'failed', str(err)
+    return src, 'done', None
+
+
+def resize_images(src, dest, sizes=[224, 224], suffix='', check='mtime',
+                  num_workers=None, chunksize=64, log_every=10000):
+    """Resize images in parallel with :func:`resize_image`.
+
+    Outputs are written to a temporary file and renamed, so interrupted
+    runs can be resumed by skipping the up-to-date outputs.
+
+    Parameters
+    ----------
+    src: source folder or a list of image files
+    dest: destination folder, the relative paths of src are kept
+    sizes: [new_height, new_width]
+    suffix: filename suffix of images when src is a folder
+    check: 'mtime', 'size' or None, how to check whether an output is
+        up to date, None to always resize
+    num_workers: number of processes, use all cpus if None
+    chunksize: number of images sent to a process at once
+    log_every: log the progress every log_every images
+
+    Return
+    ------
+    report: dict of counts, elapsed time, throughput and failures
+    """
+    if check not in ['mtime', 'size', None]:
+        raise ValueError("{} not in ['mtime', 'size', None]".format(check))
+    if isinstance(src, str):
+        root = src
+        files = iter_files(src, suffix, recursive=True)
+    else:
+        files = list(src)
+        root = os.path.commonpath(
+            [os.path.dirname(os.path.abspath(f)) for f in files] or ['.'])
+        files = [os.path.abspath(f) for f in files]
+    tasks = ((f, os.path.join(dest, os.path.relpath(f, root)), sizes, check)
+             for f in files)
+    report = dict(done=0, skipped=0, failed=0, failures=[])
+    start = time.time()
+    with ProcessPoolExecutor(num_workers) as executor:
+        results = executor.map(_resize_one, tasks, chunksize=chunksize)
+        for n, (fn, status, error) in enumerate(results, 1):
+            report[status] += 1
+            if error is not None:
+                report['failures'].append((fn, error))
+                LOGGER.warning("Failed to resize '%s': %s", fn, error)
+            if n % log_every == 0:
+                LOGGER.info('Processed %d images (%.1f images/s).',
+                            n, n / (time.time() - start))
+    report['elapsed'] = time.time() - start
+    total = report['done'] + report['skipped'] + report['failed']
+    report['throughput'] = total / max(report['elapsed'], 1e-9)
+    LOGGER.info('Resized %d, skipped %d, failed %d images in %.1fs '
+                '(%.1f images/s).', report['done'], report['skipped'],
+                report['failed'], report['elapsed'], report['throughput'])
+    return report
+
+
+def _shard_file(folder, shard):
+    return os.path.join(folder, 'shard_{:05d}.bin'.format(shard))
+
+
+class ImageShardWriter(object):
+    """Pack fixed-size images into large shard files.
+
+    Each shard is a raw uint8 file of at most shard_size images, and
+    index.json maps keys to the position of images, see
+    :class:`ImageShardReader`.
+
+    Parameters
+    ----------
+    folder: folder to save shards
+    shape: shape of each image, e.g. (height, width, depth)
+    shard_size: number of images in each shard
+    """
+
+    def __init__(self, folder, shape, shard_size=10000):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.shape = tuple(shape)
+        self.shard_size = shard_size
+        self.keys = []
+        self._file = None
+
+    def add(self, key, img):
+        """Append one image with given key."""
+        img = np.asarray(img)
+        if img.shape != self.shape or img.dtype != np.uint8:
+            raise ValueError("image must be uint8 of shape {}, got {} {}"
+                             .format(self.shape, img.dtype, img.shape))
+        if len(self.keys) % self.shard_size == 0:
+            if self._file is not None:
+                self._file.close()
+            shard = len(self.keys) // self.shard_size
+            self._file = open(_shard_file(self.folder, shard), 'wb')
+        self._file.write(np.ascontiguousarray(img).tobytes())
+        self.keys.append(key)
+
+    def close(self):
+        """Close the shard and write the index."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = dict(shape=self.shape, shard_size=self.shard_size,
+                     keys=self.keys)
+        with open(os.path.join(self.folder, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ImageShardReader(object):
+    """Random access to images written by :class:`ImageShardWriter`.
+
+    Images are zero-copy (read-only) views of memory-mapped shards. Shards
+    are opened lazily, so the reader can be pickled to DataLoader workers.
+    """
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, 'index.json')) as f:
+            index = json.load(f)
+        self.folder = folder
+        self.shape = tuple(index['shape'])
+        self.shard_size = index['shard_size']
+        self.keys = index['keys']
+        self._positions = {k: i for i, k in enumerate(self.keys)}
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            data = np.memmap(_shard_file(self.folder, shard), dtype=np.uint8,
+                             mode='r')
+            self._shards[shard] = data.reshape((-1, ) + self.shape)
+        return self._shards[shard]
+
+    def __getitem__(self, index):
+        """Return the index-th image."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index out of range')
+        shard, pos = divmod(index, self.shard_size)
+        return self._shard(shard)[pos]
+
+    def get(self, key):
+        """Return the image of key."""
+        return self[self._positions[key]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+def pack_images(files, folder, sizes=[224, 224], keys=None,
+                shard_size=10000):
+    """Resize images with :func:`letterbox` and pack them into shards.
+
+    Parameters
+    ----------
+    files: list of image files
+    folder: folder to save shards
+    sizes: [new_height, new_width]
+    keys: keys of images, files are used if None
+    shard_size: number of images in each shard
+    """
+    keys = files if keys is None else keys
+    shape = tuple(sizes) + (3, )
+    buffer = np.empty(shape, dtype=np.uint8)
+    with ImageShardWriter(folder, shape, shard_size) as writer:
+        for key, fn in zip(keys, files):
+            img = cv2.imread(fn)
+            if img is None:
+                LOGGER.warning("Failed to read '%s'.", fn)
+                continue
+            writer.add(key, letterbox(img, sizes, out=buffer))
+    return writer.keys
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Resize images in batch.')
+    parser.add_argument('src', help='source folder')
+    parser.add_argument('dest', help='destination folder')
+    parser.add_argument('--sizes', type=int, nargs=2, default=[224, 224],
+                        metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--suffix', nargs='*', default=['.jpg', '.png'])
+    parser.add_argument('--check', default='mtime',
+                        choices=['mtime', 'size', 'none'])
+    parser.add_argument('--num-workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=64)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    check = None if args.check == 'none' else args.check
+    report = resize_images(args.src, args.dest, args.sizes, args.suffix,
+                           check, args.num_workers, args.chunksize)
+    raise SystemExit(1 if report['failed'] else 0)
@@ -0,0 +1,175 @@
+"""Graph preprocessing for GNN, see :func:`utils.math.gnn_spmm`."""
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+
+LOGGER = logging.getLogger(__name__)
+
+# bumped when the normalization changes, so that old caches are not used
+_CACHE_VERSION = 1
+
+
+def _cache_key(row, col, value, num_nodes, mode, self_loop, undirected):
+    """Return the content hash of the graph and settings."""
+    sha = hashlib.sha1()
+    for array in [row, col, value]:
+        sha.update(np.ascontiguousarray(array).tobytes())
+    sha.update(repr((_CACHE_VERSION, num_nodes, mode, self_loop,
+                     undirected)).encode())
+    return sha.hexdigest()
+
+
+def _normalize(row, col, value, num_nodes, mode, self_loop, undirected):
+    """Normalize the adjacency in COO format, return entries sorted by row."""
+    if undirected:
+        row, col = np.hstack((row, col)), np.hstack((col, row))
+        value = np.hstack((value, value))
+    # merge duplicated edges by the max weight, so that edges given in both
+    # directions are not counted twice
+    keys = row * num_nodes + col
+    order = np.lexsort((value, keys))
+    keys, value = keys[order], value[order]
+    last = np.append(keys[1:] != keys[:-1], True)
+    keys, value = keys[last], value[last]
+    if self_loop:
+        # A + I
+        loop = np.arange(num_nodes) * (num_nodes + 1)
+        keys, inverse = np.unique(np.hstack((keys, loop)),
+                                  return_inverse=True)
+        value = np.bincount(inverse, minlength=len(keys),
+                            weights=np.hstack((value, np.ones(num_nodes))))
+    row, col = keys // num_nodes, keys % num_nodes
+    degree = np.bincount(row, weights=value, minlength=num_nodes)
+    with np.errstate(divide='ignore'):
+        if mode == 'sym':
+            d_inv = np.power(degree, -0.5)
+            d_inv[np.isinf(d_inv)] = 0
+            value = value * d_inv[row] * d_inv[col]
+        else:
+            d_inv = np.power(degree, -1.0)
+            d_inv[np.isinf(d_inv)] = 0
+            value = value * d_inv[row]
+    return row, col, value
+
+
+def normalize_adjacency(edges, num_nodes=None, weights=None, mode='sym',
+                        self_loop=True, undirected=True, cache_dir=None):
+    """Build the normalized sparse adjacency from an edge list.
+
+    Parameters
+    ----------
+    edges: size of (2, num_edges), source and target nodes
+    num_nodes: number of nodes, max(edges) + 1 if None
+    weights: size of (num_edges, ), edge weights, all ones if None.
+        Duplicated edges, including the reversed edges if undirected, are
+        merged by the max weight, i.e. they are not summed
+    mode: 'sym' for D^-1/2 A D^-1/2 and 'rw' for D^-1 A
+    self_loop: whether to add self loops (A + I) before normalization
+    undirected: whether to add reversed edges
+    cache_dir: if given, the result is cached by the content hash
+
+    Return
+    ------
+    adj: coalesced torch.sparse_coo_tensor of size (num_nodes, num_nodes)
+    """
+    if mode not in ['sym', 'rw']:
+        raise ValueError("{} not in ['sym', 'rw']".format(mode))
+    row, col = np.asarray(edges, dtype=np.int64)
+    if num_nodes is None:
+        num_nodes = int(max(row.max(), col.max())) + 1 if row.size else 0
+    if weights is None:
+        value = np.ones(len(row))
+    else:
+        value = np.asarray(weights, dtype=np.float64)
+    cache_file = None
+    if cache_dir is not None:
+        key = _cache_key(row, col, value, num_nodes, mode, self_loop,
+                         undirected)
+        cache_file = os.path.join(cache_dir, 'adj_{}.npz'.format(key))
+    if cache_file and os.path.isfile(cache_file):
+        LOGGER.debug("Load adjacency from '%s'.", cache_file)
+        data = np.load(cache_file)
+        row, col, value = data['row'], data['col'], data['value']
+    else:
+        row, col, value = _normalize(row, col, value, num_nodes, mode,
+                                     self_loop, undirected)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file so that the cache is never partial
+            with open(cache_file + '.tmp', 'wb') as f:
+                np.savez(f, row=row, col=col, value=value)
+            os.replace(cache_file + '.tmp', cache_file)
+            LOGGER.debug("Adjacency has been cached in '%s'.", cache_file)
+    indices = torch.from_numpy(np.vstack((row, col)))
+    adj = torch.sparse_coo_tensor(indices, torch.from_numpy(value).float(),
+                                  (num_nodes, num_nodes))
+    return adj.coalesce()
+
+
+class NeighborSampler(object):
+    """Mini-batch neighbor sampler for sparse adjacency.
+
+    The adjacency is kept in CSR arrays, and each batch only extracts the
+    rows of the batch nodes.
+
+    Parameters
+    ----------
+    adj: sparse adjacency, e.g. from :func:`normalize_adjacency`
+    fanout: max number of sampled neighbors for each node, all if None
+    """
+
+    def __init__(self, adj, fanout=None):
+        adj = adj.coalesce()
+        row, col = adj.indices().numpy()
+        self.num_nodes = adj.shape[0]
+        self.indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row, minlength=self.num_nodes),
+                  out=self.indptr[1:])
+        self.indices = col
+        self.values = adj.values().numpy()
+        self.fanout = fanout
+
+    def sample(self, nodes):
+        """Extract the sub-adjacency of nodes.
+
+        Return
+        ------
+        sub_adj: sparse matrix of size (len(nodes), len(neighbors))
+        neighbors: global ids of columns in sub_adj, i.e. the input nodes
+            for gnn_spmm(sub_adj, features[neighbors])
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.indptr[nodes]
+        counts = self.indptr[nodes + 1] - starts
+        seg = np.repeat(np.arange(len(nodes)), counts)
+        first = np.cumsum(counts) - counts
+        pos = np.arange(counts.sum()) - first[seg] + starts[seg]
+        if self.fanout is not None:
+            order = np.lexsort((np.random.rand(len(pos)), seg))
+            rank = np.arange(len(pos)) - first[seg]
+            keep = np.sort(order[rank < self.fanout])
+            pos, seg = pos[keep], seg[keep]
+        neighbors, col = np.unique(self.indices[pos], return_inverse=True)
+        indices = torch.from_numpy(np.vstack((seg, col)))
+        sub_adj = torch.sparse_coo_tensor(
+            indices, torch.from_numpy(self.values[pos]),
+            (len(nodes), len(neighbors)))
+        return sub_adj.coalesce(), torch.from_numpy(neighbors)
+
+    def batches(self, batch_size, shuffle=True):
+        """Iterate over all nodes in mini-batches.
+
+        Yield
+        -----
+        nodes, sub_adj, neighbors
+        """
+        nodes = np.arange(self.num_nodes)
+        if shuffle:
+            np.random.shuffle(nodes)
+        for start in range(0, self.num_nodes, batch_size):
+            batch = nodes[start:start + batch_size]
+            sub_adj, neighbors = self.sample(batch)
+            yield torch.from_numpy(batch), sub_adj, neighbors
@@ -1,15 +1,23 @@
 """Create simple html file."""
+import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import dominate
 import dominate.tags as htags
 
+LOGGER = logging.getLogger(__name__)
+
 
 class WebPage(object):
     """Simple html file contains concise elements."""
 
-    def __init__(self, web_dir, title, reflesh=0):
-        """Create a html file with concise elements."""
+    def __init__(self, web_dir, title, reflesh=0, incremental=False):
+        """Create a html file with concise elements.
+
+        If incremental, each save() only appends the elements added since
+        the last save() to the file, and then drops them from memory.
+        """
         # the title of the page
         self.title = title
         # dir to save the web page
@@ -22,10 +30,15 @@ class WebPage(object):
             os.makedirs(self.img_dir)
         # create a document with given title
         self.doc = dominate.document(title=title)
+        with self.doc.head:
+            htags.meta(charset='utf-8')
         # a time interval for the document to refresh itself
         if reflesh > 0:
             with self.doc.head:
-                htags.meta(http_equiv="reflesh", content=str(reflesh))
+                htags.meta(http_equiv="refresh", content=str(reflesh))
+        self.incremental = incremental
+        # the rendered end of the saved file, i.e. '</body></html>'
+        self._tail = None
 
     def add_header(self, info):
         """Add h3 header."""
@@ -57,9 +70,188 @@ class WebPage(object):
     def save(self):
         """Save html file."""
         html_file = '%s/index.html' % self.web_dir
-        f = open(html_file, 'wt')
-        f.write(self.doc.render())
+        if self.incremental and self._tail is not None:
+            self._append(html_file)
+            return
+        html = self.doc.render()
+        f = open(html_file, 'wt', encoding='utf-8')
+        f.write(html)
         f.close()
+        if self.incremental:
+            self._tail = html[html.rindex('</body>'):].encode('utf-8')
+            self.doc.main.clear()
+
+    def _append(self, html_file):
+        """Append new elements before the end of the saved file."""
+        body = self.doc.main
+        if not body.children:
+            return
+        html = '\n'.join(child.render() for child in body.children)
+        with open(html_file, 'r+b') as f:
+            f.seek(-len(self._tail), os.SEEK_END)
+            f.write(html.encode('utf-8') + b'\n' + self._tail)
+            f.truncate()
+        body.clear()
+
+
+def _make_thumbnail(args):
+    """Downscale src to given width and save it to dest if not exists."""
+    src, dest, width = args
+    if os.path.exists(dest):
+        return
+    import cv2
+    img = cv2.imread(src)
+    if img is None:
+        raise IOError("failed to read '{}'".format(src))
+    height = max(1, int(round(img.shape[0] * width / img.shape[1])))
+    if width < img.shape[1]:
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    folder, name = os.path.split(dest)
+    os.makedirs(folder, exist_ok=True)
+    # write and rename, so that interrupted runs leave no partial thumbnail
+    tmp = os.path.join(folder, '.{}.{}.tmp{}'.format(
+        name, os.getpid(), os.path.splitext(name)[1]))
+    if not cv2.imwrite(tmp, img):
+        raise IOError("failed to write '{}'".format(dest))
+    os.replace(tmp, dest)
+
+
+class Gallery(object):
+    """Paginated image gallery written to disk row by row.
+
+    Rows are rendered and written as soon as they are complete, and pages
+    are split into index_0.html, index_1.html, ... so that the document
+    tree is never kept in memory. Images are shown by thumbnails, which
+    are generated in a process pool, and link to the original images.
+
+    Parameters
+    ----------
+    web_dir: dir to save the web pages, images are in web_dir/images and
+        thumbnails are in web_dir/images/thumbnails
+    title: title of pages
+    num_cols: number of images in each row
+    rows_per_page: number of rows in each page
+    width: width of thumbnails in pixels
+    num_workers: number of processes for thumbnails
+    """
+
+    def __init__(self, web_dir, title, num_cols=4, rows_per_page=100,
+                 width=400, num_workers=None):
+        self.title = title
+        self.web_dir = web_dir
+        self.img_dir = os.path.join(self.web_dir, 'images')
+        self.thumb_dir = os.path.join(self.img_dir, 'thumbnails')
+        if not os.path.exists(self.thumb_dir):
+            os.makedirs(self.thumb_dir)
+        self.num_cols = num_cols
+        self.rows_per_page = rows_per_page
+        self.width = width
+        self.num_pages = 0
+        self._row = []
+        self._num_rows = 0
+        self._page = None
+        self._executor = ProcessPoolExecutor(num_workers)
+        self._futures = dict()
+        # list of (image, error) of failed thumbnails
+        self.failures = []
+
+    def _page_file(self, n):
+        return os.path.join(self.web_dir, 'index_%d.html' % n)
+
+    def _open_page(self):
+        n = self.num_pages
+        self._page = open(self._page_file(n), 'wt', encoding='utf-8')
+        self._page.write('<!DOCTYPE html>\n<html>\n')
+        self._page.write(htags.head(htags.meta(charset='utf-8'),
+                                    htags.title(self.title)).render())
+        self._page.write('\n<body>\n')
+        self._page.write(htags.h3('%s (page %d)' % (self.title, n)).render())
+        self._page.write('\n<table border="1" style="table-layout: fixed;">')
+        self.num_pages += 1
+        self._num_rows = 0
+
+    def _close_page(self, has_next=False):
+        n = self.num_pages - 1
+        nav = htags.p()
+        if n > 0:
+            nav.add(htags.a('prev', href='index_%d.html' % (n - 1)))
+        if has_next:
+            nav.add(htags.a('next', href='index_%d.html' % (n + 1)))
+        self._page.write('\n</table>\n')
+        self._page.write(nav.render())
+        self._page.write('\n</body>\n</html>\n')
+        self._page.close()
+        self._page = None
+        self._collect(wait=False)
+
+    def _collect(self, wait):
+        """Collect results of finished (or all if wait) thumbnails."""
+        for future in list(self._futures):
+            if not wait and not future.done():
+                continue
+            im = self._futures.pop(future)
+            try:
+                future.result()
+            except Exception as err:
+                LOGGER.warning("Failed to create thumbnail of '%s': %s",
+                               im, err)
+                self.failures.append((im, str(err)))
+
+    def _write_row(self):
+        if self._page is not None and self._num_rows == self.rows_per_page:
+            self._close_page(has_next=True)
+        if self._page is None:
+            self._open_page()
+        tr = htags.tr()
+        with tr:
+            for im, txt, link in self._row:
+                with htags.td(style="word-wrap: break-word;",
+                              halign="center",
+                              valign="top"):
+                    thumb = os.path.join('images', 'thumbnails', im)
+                    with htags.p():
+                        with htags.a(href=os.path.join('images', link)):
+                            htags.img(style="width:%dpx" % self.width,
+                                      src=thumb)
+                        htags.br()
+                        htags.p(txt)
+        self._page.write('\n' + tr.render())
+        self._num_rows += 1
+        self._row = []
+
+    def add_images(self, ims, txts, links):
+        """Add images, where ims and links are paths in img_dir."""
+        for im, txt, link in zip(ims, txts, links):
+            src = os.path.join(self.img_dir, im)
+            dest = os.path.join(self.thumb_dir, im)
+            if not os.path.exists(dest):
+                future = self._executor.submit(
+                    _make_thumbnail, (src, dest, self.width))
+                self._futures[future] = im
+            self._row.append((im, txt, link))
+            if len(self._row) == self.num_cols:
+                self._write_row()
+
+    def close(self):
+        """Write the last row and wait for thumbnails.
+
+        Return
+        ------
+        failures: list of (image, error) of failed thumbnails
+        """
+        if self._row:
+            self._write_row()
+        if self._page is not None:
+            self._close_page()
+        self._collect(wait=True)
+        self._executor.shutdown()
+        return self.failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 if __name__ == '__main__':
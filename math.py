@@ -78,16 +78,18 @@ class SPMM(torch.autograd.Function):
 
     @staticmethod
     def forward(ctx, sp_mat, dense_mat):
-        ctx.save_for_backward(sp_mat, dense_mat)
+        # the dense matrix is not needed for its own gradient
+        if ctx.needs_input_grad[1]:
+            ctx.save_for_backward(sp_mat)
 
         return torch.mm(sp_mat, dense_mat)
 
     @staticmethod
     def backward(ctx, grad_output):
-        sp_mat, _ = ctx.saved_variables
         grad_matrix1 = grad_matrix2 = None
         assert not ctx.needs_input_grad[0]
         if ctx.needs_input_grad[1]:
+            sp_mat, = ctx.saved_tensors
             grad_matrix2 = torch.mm(sp_mat.data.t(), grad_output.data)
         return grad_matrix1, grad_matrix2
 
@@ -96,6 +98,95 @@ def gnn_spmm(sp_mat, dense_mat):
     return SPMM.apply(sp_mat, dense_mat)
 
 
+class _AdjacencyMM(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, adj, dense_mat):
+        ctx.adj = adj
+        return torch.mm(adj.csr, dense_mat)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_matrix = None
+        if ctx.needs_input_grad[1]:
+            grad_matrix = torch.mm(ctx.adj.csr_t, grad_output)
+        return None, grad_matrix
+
+
+class Adjacency(object):
+    """Sparse adjacency operator for GNN.
+
+    The CSR matrix and its transpose are built once, so that it can be
+    reused by :meth:`mm` for all training steps.
+
+    Parameters
+    ----------
+    sp_mat: sparse (COO or CSR) or dense matrix
+    symmetric: if True, the transpose shares the CSR matrix
+    """
+
+    def __init__(self, sp_mat, symmetric=False):
+        if sp_mat.layout == torch.sparse_csr:
+            sp_mat = sp_mat.to_sparse_coo()
+        elif sp_mat.layout == torch.strided:
+            sp_mat = sp_mat.to_sparse()
+        sp_mat = sp_mat.coalesce()
+        self.shape = tuple(sp_mat.shape)
+        self.symmetric = symmetric
+        self.csr = sp_mat.to_sparse_csr()
+        if symmetric:
+            self.csr_t = self.csr
+        else:
+            self.csr_t = sp_mat.t().coalesce().to_sparse_csr()
+
+    def to(self, device):
+        """Return a copy of the operator on device."""
+        adj = Adjacency.__new__(Adjacency)
+        adj.shape = self.shape
+        adj.symmetric = self.symmetric
+        adj.csr = self.csr.to(device)
+        adj.csr_t = adj.csr if self.symmetric else self.csr_t.to(device)
+        return adj
+
+    def mm(self, *dense_mats):
+        """Multiply the adjacency with one or more dense matrices.
+
+        Several matrices are concatenated along columns and multiplied in
+        one call. Return a tensor for one matrix and a tuple otherwise.
+        """
+        if len(dense_mats) == 1:
+            return _AdjacencyMM.apply(self, dense_mats[0])
+        sizes = [m.shape[1] for m in dense_mats]
+        output = _AdjacencyMM.apply(self, torch.cat(dense_mats, dim=1))
+        return output.split(sizes, dim=1)
+
+    __call__ = mm
+
+
+def benchmark_spmm(num_nodes=10000, degree=10, dim=64, num_rhs=3, steps=20):
+    """Benchmark forward and backward of gnn_spmm and Adjacency on CPU."""
+    import time
+    index = torch.randint(0, num_nodes, (2, num_nodes * degree))
+    value = torch.rand(index.shape[1])
+    sp_mat = torch.sparse_coo_tensor(
+        index, value, (num_nodes, num_nodes)).coalesce()
+    xs = [torch.randn(num_nodes, dim, requires_grad=True)
+          for _ in range(num_rhs)]
+    start = time.time()
+    for _ in range(steps):
+        sum(gnn_spmm(sp_mat, x).sum() for x in xs).backward()
+    spmm = (time.time() - start) / steps
+    start = time.time()
+    adj = Adjacency(sp_mat)
+    build = time.time() - start
+    start = time.time()
+    for _ in range(steps):
+        sum(y.sum() for y in adj.mm(*xs)).backward()
+    cached = (time.time() - start) / steps
+    return dict(num_nodes=num_nodes, degree=degree, dim=dim, num_rhs=num_rhs,
+                gnn_spmm=spmm, adjacency=cached, build=build)
+
+
 def convert_to_int(x, bits=8):
     """Convert binary codes x into a set of int8.
 
@@ -138,6 +229,55 @@ def build_look_table(weights, bits=8):
     return np.array(tables)
 
 
+def pack_codes(x, bits=8):
+    """Convert a batch of binary codes into packed integers.
+
+    Vectorized version of :func:`convert_to_int`.
+
+    Parameters
+    ----------
+    x: size of (..., n), with binary value in {+1,-1}
+    Return:
+    ------
+    y: int64 array of size (..., n // bits), with each one being the
+       integer of bits, same as convert_to_int
+    """
+    x = np.asarray(x)
+    size = x.shape[-1] // bits
+    x = x[..., :size * bits] > 0
+    if bits == 8:
+        return np.packbits(x, axis=-1).astype(np.int64)
+    x = x.reshape(x.shape[:-1] + (size, bits))
+    return x.astype(np.int64) @ (1 << np.arange(bits - 1, -1, -1))
+
+
+def _binary_patterns(bits=8):
+    """Return all 2^bits values as rows of {+1,-1} (0 -> 1 , 1 -> -1)."""
+    values = np.arange(2 ** bits)[:, None]
+    shifts = np.arange(bits - 1, -1, -1)
+    return 1 - 2 * ((values >> shifts) & 1)
+
+
+def build_look_tables(weights, bits=8):
+    """Build all weighted-Hamming look-up tables at once.
+
+    Vectorized version of :func:`build_look_table`.
+
+    Parameters
+    ----------
+    weights: size of (..., n), weights for each bit
+    Return:
+    ------
+    tables: size of (..., n // bits, 2^bits)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    size = weights.shape[-1] // bits
+    weights = weights[..., :size * bits]
+    weights = weights.reshape(weights.shape[:-1] + (size, bits))
+    # same summation as _build_one_table, so the results are identical
+    return np.sum(weights[..., None, :] * _binary_patterns(bits), axis=-1)
+
+
 def hamming_sim(xs, ys, tables, offset):
     return tables[np.bitwise_xor(xs, ys) + offset].sum()
 
@@ -154,3 +294,9 @@ def test_whd(size=600, bits=8):
     sim1 = np.sum(w * a * b)
     sim2 = tables[np.bitwise_xor(x, y) + offset].sum()
     assert np.abs(sim1 - sim2) < 1e-6
+    # batched version
+    assert np.array_equal(pack_codes(np.stack([a, b]), bits), [x, y])
+    tables = build_look_tables(w, bits)
+    assert np.array_equal(tables, build_look_table(w, bits))
+    sim3 = tables.reshape(-1)[np.bitwise_xor(x, y) + offset].sum()
+    assert np.abs(sim1 - sim3) < 1e-6
@@ -61,7 +61,7 @@ class GlobalMeter(object):
         self.x = []
         self.y = []
         self.weights = []
-        self.val = np.NaN
+        self.val = np.nan
         self._cum_val = 0.0
         self._cum_weight = 0.0
 
@@ -0,0 +1,381 @@
+"""Weighted Hamming search over packed binary codes.
+
+The database is a memory-mapped ``.npy`` file of packed ``uint8`` codes
+(see :func:`utils.math.pack_codes`). Similarity is the weighted Hamming
+similarity of :func:`utils.math.hamming_sim`, i.e. the look-up tables are
+indexed by ``xor(query, item)`` for each byte and summed.
+"""
+import logging
+import os
+import time
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+import numpy as np
+
+from utils.math import build_look_tables, pack_codes
+
+LOGGER = logging.getLogger(__name__)
+
+_BITS = 8
+# default max number of (query, item, byte) entries scored at once, each
+# entry takes 17 bytes of scratch memory (uint8 xor, int64 index and
+# float64 gather)
+_MAX_ENTRIES = 1 << 22
+
+
+def write_codes(fn, codes, batch_size=65536):
+    """Pack binary codes and save them as a memory-mapped database.
+
+    Parameters
+    ----------
+    fn: the ``.npy`` file to save
+    codes: size of (N, n_bits), with binary value in {+1,-1}
+    batch_size: number of codes packed at once
+
+    Return
+    ------
+    db: the memory-mapped database of size (N, n_bits // 8)
+    """
+    num, n_bits = codes.shape
+    db = np.lib.format.open_memmap(
+        fn, mode='w+', dtype=np.uint8, shape=(num, n_bits // _BITS))
+    for start in range(0, num, batch_size):
+        stop = min(start + batch_size, num)
+        db[start:stop] = pack_codes(codes[start:stop], _BITS)
+    db.flush()
+    return db
+
+
+def _top_k(scores, index, k):
+    """Keep the k largest scores of each row with partial selection."""
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        index = np.take_along_axis(index, part, axis=1)
+    return scores, index
+
+
+def _search_block(fn, start, stop, queries, tables, k, max_entries):
+    """Score all queries against items [start, stop) of the database."""
+    db = np.load(fn, mmap_mode='r')[start:stop]
+    num_queries, n_bytes = queries.shape
+    offset = np.arange(n_bytes) * (2 ** _BITS)
+    # score chunks of (queries, items) with at most max_entries entries and
+    # merge each chunk into the running top-k of the queries
+    size = min(len(db), max(1, max_entries // n_bytes))
+    step = max(1, max_entries // (size * n_bytes))
+    k = min(k, len(db))
+    scores = np.empty((num_queries, k), dtype=tables.dtype)
+    index = np.empty((num_queries, k), dtype=np.int64)
+    for q in range(0, num_queries, step):
+        query = queries[q:q + step, None, :]
+        s = np.empty((len(query), 0), dtype=tables.dtype)
+        i = np.empty((len(query), 0), dtype=np.int64)
+        for n in range(0, len(db), size):
+            items = db[n:n + size]
+            xor = np.bitwise_xor(query, items[None, :, :])
+            ids = np.arange(start + n, start + n + len(items))
+            s = np.hstack((s, tables[xor + offset].sum(axis=-1)))
+            i = np.hstack((i, np.broadcast_to(ids, (len(query), len(ids)))))
+            s, i = _top_k(s, i, k)
+        scores[q:q + step], index[q:q + step] = s, i
+    return scores, index
+
+
+class HammingSearch(object):
+    """Batched top-K weighted Hamming search over a code database.
+
+    Parameters
+    ----------
+    fn: ``.npy`` file of packed codes, see :func:`write_codes`
+    weights: size of (n_bits, ), weights for each bit
+    block_size: number of items scored per task
+    num_workers: number of workers, use all cpus if None
+    executor: 'thread' or 'process'
+    max_entries: max number of (query, item, byte) entries scored at once
+        by each worker, which takes about 17 * max_entries bytes of memory
+        besides the (Q, k) results
+    """
+
+    def __init__(self, fn, weights, block_size=65536, num_workers=None,
+                 executor='thread', max_entries=_MAX_ENTRIES):
+        if executor not in ['thread', 'process']:
+            raise ValueError(
+                "{} not in ['thread', 'process']".format(executor))
+        self.fn = fn
+        self.db = np.load(fn, mmap_mode='r')
+        self.tables = build_look_tables(weights, _BITS).reshape(-1)
+        if self.tables.size != self.db.shape[1] * (2 ** _BITS):
+            raise ValueError("weights do not match the code length.")
+        self.block_size = block_size
+        self.num_workers = num_workers or os.cpu_count()
+        self.executor = executor
+        self.max_entries = max_entries
+
+    def __len__(self):
+        return len(self.db)
+
+    def search(self, queries, k=10):
+        """Return the top-k items for each query.
+
+        Parameters
+        ----------
+        queries: size of (Q, n_bytes), packed codes of queries
+        k: number of items to retrieve
+
+        Return
+        ------
+        scores: size of (Q, k), similarities in descending order
+        index: size of (Q, k), indices of items in database
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.uint8))
+        k = min(k, len(self))
+        pool = {'thread': ThreadPoolExecutor,
+                'process': ProcessPoolExecutor}[self.executor]
+        scores = np.empty((len(queries), 0), dtype=self.tables.dtype)
+        index = np.empty((len(queries), 0), dtype=np.int64)
+        with pool(self.num_workers) as executor:
+            futures = [
+                executor.submit(_search_block, self.fn, start,
+                                min(start + self.block_size, len(self)),
+                                queries, self.tables, k, self.max_entries)
+                for start in range(0, len(self), self.block_size)
+            ]
+            for future in as_completed(futures):
+                s, i = future.result()
+                scores, index = _top_k(np.hstack((scores, s)),
+                                       np.hstack((index, i)), k)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        scores = np.take_along_axis(scores, order, axis=1)
+        index = np.take_along_axis(index, order, axis=1)
+        return scores, index
+
+
+_POPCOUNT = np.unpackbits(
+    np.arange(2 ** _BITS, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+
+def hamming_dist(xs, ys):
+    """Return the Hamming distance between packed codes (along last axis)."""
+    return _POPCOUNT[np.bitwise_xor(xs, ys)].sum(axis=-1)
+
+
+def _flip_masks(n_bits, radius):
+    """Return all masks of n_bits with at most radius bits set."""
+    from itertools import combinations
+    masks = [0]
+    for r in range(1, min(radius, n_bits) + 1):
+        for bits in combinations(range(n_bits), r):
+            masks.append(sum(1 << b for b in bits))
+    return masks
+
+
+class MultiIndexHashing(object):
+    """Multi-index hashing for Hamming-radius retrieval.
+
+    Codes are split into ``num_tables`` disjoint substrings of bytes, and
+    each substring is indexed by a hash table. An item within radius r of
+    the query must match in at least one substring within radius
+    ``r // num_tables``, so only those buckets are probed.
+
+    Parameters
+    ----------
+    n_bytes: number of bytes of packed codes
+    num_tables: number of substrings, n_bytes // 2 if None
+    weights: size of (n_bytes * 8, ), weights for re-ranking candidates
+    """
+
+    def __init__(self, n_bytes, num_tables=None, weights=None):
+        num_tables = num_tables or max(1, n_bytes // 2)
+        self.n_bytes = n_bytes
+        self.num_tables = num_tables
+        self._splits = np.array_split(np.arange(n_bytes), num_tables)
+        if max(len(s) for s in self._splits) > 8:
+            raise ValueError("substrings must be no longer than 8 bytes.")
+        self.weights = weights
+        self.tables = None
+        if weights is not None:
+            self.tables = build_look_tables(weights, _BITS).reshape(-1)
+        self._offset = np.arange(n_bytes) * (2 ** _BITS)
+        self._codes = np.empty((0, n_bytes), dtype=np.uint8)
+        self._alive = np.empty(0, dtype=bool)
+        self._size = 0
+        self._buckets = [dict() for _ in range(num_tables)]
+        self._masks = dict()
+
+    def __len__(self):
+        return int(self._alive[:self._size].sum())
+
+    def _keys(self, codes, n):
+        """Return the integer keys of n-th substring of codes."""
+        keys = np.zeros(len(codes), dtype=np.uint64)
+        for i in self._splits[n]:
+            keys = (keys << np.uint64(_BITS)) | codes[:, i]
+        return keys
+
+    def insert(self, codes):
+        """Insert packed codes, return their ids."""
+        codes = np.atleast_2d(np.asarray(codes, dtype=np.uint8))
+        start, stop = self._size, self._size + len(codes)
+        if stop > len(self._codes):
+            capacity = max(stop, 2 * len(self._codes))
+            self._codes = np.resize(self._codes, (capacity, self.n_bytes))
+            self._alive = np.resize(self._alive, capacity)
+        self._codes[start:stop] = codes
+        self._alive[start:stop] = True
+        self._size = stop
+        ids = np.arange(start, stop)
+        for n, buckets in enumerate(self._buckets):
+            keys = self._keys(codes, n)
+            order = np.argsort(keys, kind='stable')
+            uniq, first = np.unique(keys[order], return_index=True)
+            groups = np.split(ids[order], first[1:])
+            for key, group in zip(uniq.tolist(), groups):
+                buckets.setdefault(key, []).extend(group.tolist())
+        return ids
+
+    def delete(self, ids):
+        """Delete items by ids."""
+        ids = np.atleast_1d(ids)
+        codes = self._codes[ids]
+        self._alive[ids] = False
+        for n, buckets in enumerate(self._buckets):
+            for key, i in zip(self._keys(codes, n).tolist(), ids.tolist()):
+                bucket = buckets.get(key, [])
+                if i in bucket:
+                    bucket.remove(i)
+                if not bucket:
+                    buckets.pop(key, None)
+
+    def candidates(self, query, radius):
+        """Return ids of items that may be within radius of query."""
+        query = np.asarray(query, dtype=np.uint8)[None]
+        radius = radius // self.num_tables
+        found = []
+        for n, buckets in enumerate(self._buckets):
+            n_bits = len(self._splits[n]) * _BITS
+            masks = self._masks.get((n_bits, radius))
+            if masks is None:
+                masks = _flip_masks(n_bits, radius)
+                self._masks[(n_bits, radius)] = masks
+            key = int(self._keys(query, n)[0])
+            for mask in masks:
+                found.extend(buckets.get(key ^ mask, []))
+        return np.unique(np.array(found, dtype=np.int64))
+
+    def search(self, query, radius, k=None):
+        """Return items within radius of query.
+
+        Items are ranked by weighted Hamming similarity if weights are
+        given, otherwise by Hamming distance.
+
+        Return
+        ------
+        ids: ids of items
+        dists: Hamming distances of items
+        sims: weighted similarities of items, None without weights
+        """
+        query = np.asarray(query, dtype=np.uint8)
+        ids = self.candidates(query, radius)
+        dists = hamming_dist(self._codes[ids], query)
+        ids, dists = ids[dists <= radius], dists[dists <= radius]
+        sims = None
+        if self.tables is not None:
+            xor = np.bitwise_xor(self._codes[ids], query)
+            sims = self.tables[xor + self._offset].sum(axis=-1)
+            order = np.argsort(-sims, kind='stable')
+            sims = sims[order][:k]
+        else:
+            order = np.argsort(dists, kind='stable')
+        return ids[order][:k], dists[order][:k], sims
+
+    def save(self, fn):
+        """Save codes and settings, hash tables are rebuilt by load."""
+        alive = self._alive[:self._size]
+        # write through a file, so that np.savez does not append '.npz'
+        with open(fn, 'wb') as f:
+            np.savez(f, codes=self._codes[:self._size], alive=alive,
+                     num_tables=self.num_tables,
+                     weights=[] if self.weights is None else self.weights)
+
+    @classmethod
+    def load(cls, fn):
+        """Load from file saved by :meth:`save`, ids are preserved."""
+        data = np.load(fn)
+        weights = data['weights'] if data['weights'].size else None
+        codes = data['codes']
+        index = cls(codes.shape[1], int(data['num_tables']), weights)
+        index.insert(codes)
+        deleted = np.flatnonzero(~data['alive'])
+        if deleted.size:
+            index.delete(deleted)
+        return index
+
+
+def benchmark(num=200000, n_bits=64, num_queries=100, k=10, **kwargs):
+    """Benchmark recall and latency of :class:`HammingSearch`.
+
+    The exact top-k is computed with dense +-1 codes, i.e. sum(w * a * b).
+    """
+    import tempfile
+    codes = np.random.choice([-1, 1], (num, n_bits)).astype(np.int8)
+    query_codes = np.random.choice([-1, 1], (num_queries, n_bits))
+    weights = np.random.randn(n_bits)
+    with tempfile.TemporaryDirectory() as folder:
+        fn = os.path.join(folder, 'codes.npy')
+        write_codes(fn, codes)
+        engine = HammingSearch(fn, weights, **kwargs)
+        start = time.time()
+        _, index = engine.search(pack_codes(query_codes), k)
+        latency = time.time() - start
+        del engine
+    exact = (query_codes * weights) @ codes.T
+    kth = -np.partition(-exact, k - 1, axis=1)[:, k - 1:k]
+    found = np.take_along_axis(exact, index, axis=1)
+    recall = float(np.mean(found >= kth - 1e-9))
+    result = dict(num=num, n_bits=n_bits, num_queries=num_queries, k=k,
+                  latency=latency, qps=num_queries / latency, recall=recall)
+    LOGGER.info('HammingSearch benchmark: %s', result)
+    return result
+
+
+def benchmark_mih(num=200000, n_bits=64, num_queries=100,
+                  radii=(0, 2, 4, 6, 8), num_tables=None):
+    """Benchmark :class:`MultiIndexHashing` against brute force."""
+    codes = np.random.randint(0, 2 ** _BITS, (num, n_bits // _BITS),
+                              dtype=np.uint8)
+    # perturb database items so that queries have near neighbors
+    queries = codes[np.random.choice(num, num_queries)].copy()
+    flips = np.random.randint(0, n_bits, (num_queries, 3))
+    for q, bits in enumerate(flips):
+        for b in bits:
+            queries[q, b // _BITS] ^= np.uint8(1 << (b % _BITS))
+    start = time.time()
+    index = MultiIndexHashing(n_bits // _BITS, num_tables)
+    index.insert(codes)
+    build = time.time() - start
+    results = []
+    for radius in radii:
+        start = time.time()
+        found = [index.search(q, radius)[0] for q in queries]
+        mih = time.time() - start
+        start = time.time()
+        exact = [np.flatnonzero(hamming_dist(codes, q) <= radius)
+                 for q in queries]
+        brute = time.time() - start
+        assert all(set(a.tolist()) == set(b.tolist())
+                   for a, b in zip(found, exact))
+        result = dict(num=num, n_bits=n_bits, radius=radius, build=build,
+                      mih=mih / num_queries, brute=brute / num_queries,
+                      speedup=brute / mih)
+        LOGGER.info('MultiIndexHashing benchmark: %s', result)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for executor in ['thread', 'process']:
+        benchmark(executor=executor)
+    benchmark_mih()